@@ -11,5 +11,8 @@ setup(
         "pytest==8.1.1",
         "tqdm==4.67.1",
     ],
+    extras_require={
+        "test": ["pytest-xdist==3.5.0"],
+    },
     python_requires=">=3.9.6",
 )
@@ -0,0 +1,17 @@
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+@lru_cache(maxsize=4096)
+def header_timestamp(date_received: str) -> int:
+    """Parse an email Date header into a Unix timestamp, raising if it is malformed.
+    
+    Shared by storage and rule evaluation so both see the same time for an
+    email. Cached because emails in the same thread or sync often share a
+    Date header; failures raise and so are never cached.
+    """
+    # Handles RFC 2822 dates with or without weekday or a "(UTC)" comment
+    date = parsedate_to_datetime(date_received)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)  # "-0000" means UTC with unknown origin
+    return int(date.timestamp())
@@ -1,20 +1,96 @@
 import sqlite3
-from datetime import datetime
+from contextlib import contextmanager
 import time
-from typing import List, Dict
+from itertools import chain, islice
+from typing import Iterable, Iterator, List, Dict
 import json
 import logging
 
+from src.date_utils import header_timestamp
+
 class EmailStorage:
     """Manages email storage in SQLite."""
 
+    CACHED_STATEMENTS = 256  # Size of the connection's prepared-statement cache
+    BULK_LOAD_THRESHOLD = 1000  # Batches larger than this (and than the table) rebuild the date index once instead
+    FETCH_SIZE = 10000  # Rows fetched per call while iterating over stored emails
+
+    # Compact label encoding; json.dumps with custom separators would build a
+    # new encoder on every call, so one is kept for reuse
+    _encode_labels = json.JSONEncoder(separators=(',', ':')).encode
+
+    # Insert new email, or update the labels if they changed and fill in a body
+    # that was stored empty (synced while no rule needed bodies), so re-syncing
+    # unchanged emails writes nothing
+    _INSERT_TEMPLATE = '''
+        INSERT INTO emails (message_id, thread_id, from_email, subject, date_received, labels, message)
+        VALUES {values}
+        ON CONFLICT(message_id) DO UPDATE SET
+            labels = excluded.labels,
+            message = CASE WHEN IFNULL(emails.message, '') = '' THEN excluded.message ELSE emails.message END
+        WHERE emails.labels IS NOT excluded.labels
+           OR (IFNULL(emails.message, '') = '' AND excluded.message != '')
+    '''
+    _ROW_PLACEHOLDERS = '(?, ?, ?, ?, ?, ?, ?)'
+    _INSERT_SQL = _INSERT_TEMPLATE.format(values=_ROW_PLACEHOLDERS)
+
+    # Rows per multi-row INSERT; 128 rows x 7 columns stays under SQLite's
+    # default limit of 999 bound parameters per statement
+    _MULTI_ROW_COUNT = 128
+    _INSERT_MULTI_SQL = _INSERT_TEMPLATE.format(values=', '.join([_ROW_PLACEHOLDERS] * _MULTI_ROW_COUNT))
+
+    # Secondary indexes as (name, column) pairs
+    _INDEXES = (
+        ('idx_date_received', 'date_received'),  # Faster date range queries
+        ('idx_thread_id', 'thread_id'),          # Faster thread lookups
+    )
+
+    _SELECT_SQL = '''
+        SELECT message_id, thread_id, from_email, subject, date_received, labels, message
+        FROM emails
+    '''
+
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self.conn = self._connect()
         self._init_db()
 
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection with the per-connection PRAGMAs applied."""
+        # Autocommit mode: transactions are managed explicitly via _transaction()
+        # _INSERT_SQL is passed as the same string object on every call so it
+        # keeps hitting the prepared-statement cache
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                               cached_statements=self.CACHED_STATEMENTS)
+        # WAL only needs a single sync per checkpoint, so NORMAL is still durable
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')  # 64 MB page cache
+        conn.execute('PRAGMA mmap_size=268435456')  # Read pages through a 256 MB memory map
+        return conn
+
+    @contextmanager
+    def _transaction(self, mode: str = ''):
+        """Run the enclosed statements in one transaction on the shared connection."""
+        self.conn.execute(f'BEGIN {mode}')
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def close(self):
+        """Close the underlying database connection."""
+        self.conn.close()
+
     def _init_db(self):
         """Initialize the database with the necessary tables."""
-        with sqlite3.connect(self.db_path) as conn:
+        conn = self.conn
+        # Journal mode is persistent in the database file, so set it once here
+        conn.execute('PRAGMA journal_mode=WAL')
+        
+        with self._transaction():
             # Email storage table
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS emails (
@@ -28,11 +104,52 @@ class EmailStorage:
                 )
             ''')
             
-            # Create an index on date_received for faster queries
-            conn.execute('CREATE INDEX IF NOT EXISTS idx_date_received ON emails(date_received)')
+            self._create_indexes(conn)
+            # No query can use a sender index (LIKE is case-insensitive), so
+            # drop it from databases created while it existed
+            conn.execute('DROP INDEX IF EXISTS idx_from_email')
+
+    def _create_indexes(self, conn: sqlite3.Connection):
+        """Create the secondary indexes if they do not exist."""
+        for name, column in self._INDEXES:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON emails({column})')
+
+    def _drop_date_index(self, conn: sqlite3.Connection):
+        """Drop the date index so bulk inserts skip its upkeep."""
+        conn.execute('DROP INDEX IF EXISTS idx_date_received')
+
+    @staticmethod
+    def _parse_date(date_received: str) -> int:
+        """Convert an email Date header into a Unix timestamp.
+        
+        Args:
+            date_received: Raw Date header value
             
-            # Create an index on thread_id for faster queries
-            conn.execute('CREATE INDEX IF NOT EXISTS idx_thread_id ON emails(thread_id)')
+        Returns:
+            Unix timestamp, or the current time if the date could not be parsed
+        """
+        try:
+            return header_timestamp(date_received)
+        except (TypeError, ValueError, IndexError):
+            logging.warning("Failed to parse date '%s'. Using current time as fallback.", date_received)
+            return int(time.time())  # Fallback to current timestamp
+
+    @classmethod
+    def _to_row(cls, email: Dict) -> tuple:
+        """Build the INSERT parameters for a single email."""
+        return (email['message_id'], email.get('thread_id', ''), email['from'], email['subject'],
+                cls._parse_date(email['date_received']),
+                cls._encode_labels(sorted(email['labels'])),  # Sorted so equal label sets compare equal in SQL
+                email.get('message', ''))
+
+    def _insert_rows(self, conn: sqlite3.Connection, rows: List[tuple]):
+        """Insert rows using multi-row statements, with single-row inserts for the remainder."""
+        full_chunks_end = len(rows) - len(rows) % self._MULTI_ROW_COUNT
+        for start in range(0, full_chunks_end, self._MULTI_ROW_COUNT):
+            chunk = rows[start:start + self._MULTI_ROW_COUNT]
+            conn.execute(self._INSERT_MULTI_SQL, tuple(chain.from_iterable(chunk)))
+        if full_chunks_end < len(rows):
+            conn.executemany(self._INSERT_SQL, rows[full_chunks_end:])
 
     def save_email(self, email: Dict) -> int:
         """Store a single email in the database and return its date.
@@ -43,81 +160,99 @@ class EmailStorage:
         Returns:
             Unix timestamp of the email's received date
         """
-        date_str = email['date_received'].split(' (')[0]  # Remove anything like "(UTC)"
+        row = self._to_row(email)
+            
+        # Use UPSERT to insert new email or update only the labels if it already exists
+        self.conn.execute(self._INSERT_SQL, row)
+            
+        logging.debug("Saved/updated email with ID %s to database", email['message_id'])
+        return row[4]
         
-        # List of date formats to try
-        date_formats = [
-            '%a, %d %b %Y %H:%M:%S %z',  # Standard RFC format: 'Mon, 15 Mar 2023 10:30:45 +0000'
-            '%d %b %Y %H:%M:%S %z',      # Format without weekday: '29 Nov 2024 09:39:18 +0000'
-        ]
+    def save_emails(self, emails: List[Dict]):
+        """Store multiple emails in the database within a single transaction."""
+        if not emails:
+            logging.info("No emails to save")
+            return
+        # Rebuilding the date index only pays off when the batch is at least as
+        # large as what is already stored, e.g. the first sync
+        if len(emails) > self.BULK_LOAD_THRESHOLD and len(emails) >= self.get_email_count():
+            self.bulk_load(emails)
+            return
+            
+        rows = [self._to_row(email) for email in emails]
         
-        date = None
-        for date_format in date_formats:
-            try:
-                date = int(datetime.strptime(date_str, date_format).timestamp())
-                break  # Successfully parsed the date, exit the loop
-            except ValueError:
-                continue  # Try the next format
+        # One explicit write transaction for the whole batch instead of one per row
+        with self._transaction('IMMEDIATE') as conn:
+            self._insert_rows(conn, rows)
+        logging.info("Successfully processed %d emails (new or updated) in database", len(emails))
+
+    def save_stream(self, emails: Iterable[Dict], chunk_size: int = 1000) -> int:
+        """Store emails from an iterable, committing one transaction per chunk.
         
-        if date is None:
-            logging.warning("Failed to parse date '%s' with any known format. Using current time as fallback.", email['date_received'])
-            date = int(time.time())  # Final fallback to current timestamp
-            
-        message_content = email.get('message', '')
+        Unlike save_emails, the emails are consumed lazily so the whole
+        mailbox never has to be held in memory at once. When the table starts
+        out empty, as on the first sync, the date index is built once at the
+        end instead of being updated for every row.
+        
+        Args:
+            emails: Iterable of email dictionaries, e.g. a fetch generator
+            chunk_size: Number of rows written per transaction
             
-        with sqlite3.connect(self.db_path) as conn:
-            # Use UPSERT to insert new email or update only the labels if it already exists
-            conn.execute('''
-                INSERT INTO emails (message_id, thread_id, from_email, subject, date_received, labels, message)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(message_id) DO UPDATE SET labels = excluded.labels
-            ''', (email['message_id'], email.get('thread_id', ''), email['from'], email['subject'], date, json.dumps(email['labels']), message_content))
-            conn.commit()
+        Returns:
+            Number of emails processed
+        """
+        emails = iter(emails)
+        count = 0
+        defer_date_index = self.get_email_count() == 0
+        if defer_date_index:
+            with self._transaction('IMMEDIATE') as conn:
+                self._drop_date_index(conn)
+        try:
+            while True:
+                rows = [self._to_row(email) for email in islice(emails, chunk_size)]
+                if not rows:
+                    break
+                with self._transaction('IMMEDIATE') as conn:
+                    self._insert_rows(conn, rows)
+                count += len(rows)
+        finally:
+            if defer_date_index:
+                # Rebuilt even if fetching failed part way, for the rows saved so far
+                with self._transaction('IMMEDIATE') as conn:
+                    self._create_indexes(conn)
             
-        logging.debug("Saved/updated email with ID %s to database", email['message_id'])
-        return date
+        logging.info("Successfully processed %d emails (new or updated) in database", count)
+        return count
+
+    def bulk_load(self, emails: List[Dict]):
+        """Store a large batch of emails, rebuilding the date index once afterwards.
         
-    def save_emails(self, emails: List[Dict]):
-        """Store multiple emails in the database."""
+        Intended for first-time imports, where building the date index once is
+        cheaper than updating it for every inserted row. The other indexes are
+        kept, so the cost does not grow with rows already in the table.
+        """
         if not emails:
             logging.info("No emails to save")
             return
             
-        with sqlite3.connect(self.db_path) as conn:
-            for email in emails:
-                date_str = email['date_received'].split(' (')[0]  # Remove anything like "(UTC)"
-                
-                # List of date formats to try
-                date_formats = [
-                    '%a, %d %b %Y %H:%M:%S %z',  # Standard RFC format: 'Mon, 15 Mar 2023 10:30:45 +0000'
-                    '%d %b %Y %H:%M:%S %z',      # Format without weekday: '29 Nov 2024 09:39:18 +0000'
-                ]
-                
-                date = None
-                for date_format in date_formats:
-                    try:
-                        date = int(datetime.strptime(date_str, date_format).timestamp())
-                        break  # Successfully parsed the date, exit the loop
-                    except ValueError:
-                        continue  # Try the next format
-                
-                if date is None:
-                    logging.warning("Failed to parse date '%s' with any known format. Using current time as fallback.", email['date_received'])
-                    date = int(time.time())  # Final fallback to current timestamp
-                
-                message_content = email.get('message', '')
-                
-                # Use UPSERT to insert new email or update only the labels if it already exists
-                conn.execute('''
-                    INSERT INTO emails (message_id, thread_id, from_email, subject, date_received, labels, message)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(message_id) DO UPDATE SET labels = excluded.labels
-                ''', (email['message_id'], email.get('thread_id', ''), email['from'], email['subject'], date, json.dumps(email['labels']), message_content))
-            conn.commit()
-            logging.info("Successfully processed %d emails (new or updated) in database", len(emails))
+        rows = [self._to_row(email) for email in emails]
+        
+        with self._transaction('IMMEDIATE') as conn:
+            self._drop_date_index(conn)
+            self._insert_rows(conn, rows)
+            self._create_indexes(conn)  # Only the dropped date index is missing
+        logging.info("Successfully bulk loaded %d emails into database", len(emails))
+
+    def iter_emails(self) -> Iterator[tuple]:
+        """Lazily yield stored emails, fetching rows from SQLite in blocks."""
+        cursor = self.conn.execute(self._SELECT_SQL)
+        while rows := cursor.fetchmany(self.FETCH_SIZE):
+            yield from rows
 
     def get_all_emails(self) -> List[tuple]:
         """Retrieve all stored emails."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute('SELECT * FROM emails')
-            return cursor.fetchall()
+        return list(self.iter_emails())
+
+    def get_email_count(self) -> int:
+        """Return the number of stored emails without loading them."""
+        return self.conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
@@ -1,8 +1,13 @@
 import os
 from tqdm import tqdm
 import logging
+import threading
 import time
-from typing import List, Dict, Optional
+from base64 import urlsafe_b64decode
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Dict, Optional
 from google.auth.transport.requests import Request
 
 from google.oauth2.credentials import Credentials
@@ -23,6 +28,14 @@ class GmailClient:
     SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
     SERVICE_NAME = 'gmail'
     SERVICE_VERSION = 'v1'
+    BATCH_SIZE = 100  # Maximum number of calls Gmail accepts in one batch request
+    MODIFY_BATCH_SIZE = 1000  # Maximum number of IDs accepted by messages.batchModify
+    METADATA_HEADERS = ['From', 'Subject', 'Date']  # Headers used by rules and storage
+    MAX_WORKERS = 16  # Concurrent per-message fetches when batching is disabled
+    MAX_IN_FLIGHT = 50  # Per-message fetches allowed to run ahead of the consumer
+    MAX_RETRIES = 5  # Retries, with exponential backoff, for messages that failed in a batch
+    RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})  # Rate limits and transient server errors
+    RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')  # Rate limits reported as 403
 
     def __init__(self, credentials_path: str, token_path: str):
         """Initialize the GmailClient.
@@ -33,6 +46,8 @@ class GmailClient:
         """
         self.credentials_path = credentials_path
         self.token_path = token_path
+        self.credentials = None
+        self._local = threading.local()
         self.service = self._authenticate()
 
     def _authenticate(self):
@@ -84,22 +99,54 @@ class GmailClient:
              except Exception as e:
                 logging.error("Error saving credentials to token file: %s", e)
         
+        self.credentials = creds
         try:
-            service = build(self.SERVICE_NAME, self.SERVICE_VERSION, credentials=creds)
+            service = self._build_service()
             logging.info("Successfully built Gmail API service")
             return service
         except Exception as e:
             raise GmailAPIError(f"Failed to build Gmail API service: {e}") from e
 
-    def fetch_inbox_emails(self, look_back: int = None) -> List[Dict]:
+    def _build_service(self):
+        """Build a Gmail API service.
+        
+        The discovery cache is disabled, so start-up (and each worker thread's
+        service) skips probing for a cache backend that is not installed.
+        """
+        return build(self.SERVICE_NAME, self.SERVICE_VERSION, credentials=self.credentials,
+                     cache_discovery=False)
+
+    def _thread_service(self):
+        """Return a Gmail API service owned by the calling thread.
+        
+        The underlying HTTP transport is not thread-safe, so each worker
+        thread builds and caches its own service object.
+        """
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._build_service()
+            self._local.service = service
+        return service
+
+    def fetch_inbox_emails(self, look_back: int = None, use_batch: bool = True,
+                           fetch_body: bool = True) -> Iterator[Dict]:
         """
         Fetch emails from the Inbox in batches since the last fetch.
         
+        The first page of message IDs is listed up front, so listing errors
+        are raised immediately; later pages are listed as the details are
+        streamed lazily, so callers can store each email without holding the
+        whole mailbox in memory and fetching overlaps with paging.
+        
         Args:
             look_back: Number of days to look back for emails
+            use_batch: Fetch details with batch HTTP requests; when False,
+                fetch them one per request from a pool of worker threads
+            fetch_body: Download the full message; when False, only the
+                headers needed for rules are requested and 'message' is empty
         
         Returns:
-            List of email details
+            Iterator over email details
         """
         logging.info("Starting to fetch emails from Inbox")
         
@@ -112,11 +159,17 @@ class GmailClient:
         else:
             logging.info("Fetching all emails as no look back provided")
         
+        pages = self._list_message_pages(query)
+        # List the first page now so listing errors are raised immediately; later
+        # pages are listed while details for the earlier ones are being fetched
+        first_page = next(pages, [])
+        return self._iter_email_details(chain([first_page], pages), use_batch, fetch_body)
+
+    def _list_message_pages(self, query: Optional[str]) -> Iterator[List[Dict]]:
+        """Yield each page of listed messages as soon as it is received."""
+        total = 0
+        page_token = None
         try:
-            # Fetch all messages in batches
-            all_messages = []
-            page_token = None
-            
             while True:
                 response = self.service.users().messages().list(
                     userId='me', 
@@ -130,98 +183,197 @@ class GmailClient:
                 if not messages:
                     break
 
-                all_messages.extend(messages)
+                total += len(messages)
+                yield messages
                 
                 page_token = response.get('nextPageToken')
                 if not page_token:
                     break
-            
-            logging.info("Successfully received metadata for %s emails from Gmail API", len(all_messages))
-            
-            # Fetch and save email details with a progress bar, one at a time
-            emails = []
-            logging.info("Fetching and saving details for %s emails from mailbox...", len(all_messages))
-            
-            with tqdm(total=len(all_messages), desc="Processing emails") as pbar:
-                for msg in all_messages:
-                    # Fetch email details
-                    email = self._get_email_details(msg['id'])
-                    emails.append(email)
-                        
-                    pbar.update(1)
-            
-            processed_count = len(emails)
-            logging.info("Successfully processed %s emails from Inbox", processed_count)
-            return emails
+        except HttpError as e:
+            raise GmailAPIError(f"Failed to fetch emails: {e}") from e
+        except Exception as e:
+            raise GmailAPIError(f"Unexpected error while fetching emails: {e}") from e
 
+        logging.info("Successfully received metadata for %s emails from Gmail API", total)
+
+    def _iter_email_details(self, pages: Iterator[List[Dict]], use_batch: bool, fetch_body: bool) -> Iterator[Dict]:
+        """Yield email details for the listed messages as they are fetched."""
+        logging.info("Fetching email details as message pages arrive...")
+        processed_count = 0
+
+        try:
+            with tqdm(total=0, desc="Processing emails") as pbar:
+                pages = self._track_pages(pages, pbar)
+                if use_batch:
+                    details = self._iter_batched_details(pages, fetch_body)
+                else:
+                    details = self._iter_threaded_details(pages, fetch_body)
+                for email in details:
+                    processed_count += 1
+                    yield email
+                    pbar.update(1)
         except HttpError as e:
             raise GmailAPIError(f"Failed to fetch emails: {e}") from e
+        except GmailAPIError:
+            raise
         except Exception as e:
             raise GmailAPIError(f"Unexpected error while fetching emails: {e}") from e
 
-    def _get_email_details(self, msg_id: str) -> Dict:
+        logging.info("Successfully processed %s emails from Inbox", processed_count)
+
+    @staticmethod
+    def _track_pages(pages: Iterator[List[Dict]], pbar) -> Iterator[List[Dict]]:
+        """Grow the progress bar total as each page of messages is listed."""
+        for page in pages:
+            pbar.total += len(page)
+            pbar.refresh()
+            yield page
+
+    def _iter_batched_details(self, pages: Iterator[List[Dict]], fetch_body: bool) -> Iterator[Dict]:
+        """Fetch details with one batch request per BATCH_SIZE listed messages."""
+        msg_ids = []
+        for page in pages:
+            msg_ids.extend(msg['id'] for msg in page)
+            # Send each batch as soon as enough IDs have been listed
+            while len(msg_ids) >= self.BATCH_SIZE:
+                yield from self._get_email_details_batch(msg_ids[:self.BATCH_SIZE], fetch_body)
+                del msg_ids[:self.BATCH_SIZE]
+        if msg_ids:
+            yield from self._get_email_details_batch(msg_ids, fetch_body)
+
+    def _iter_threaded_details(self, pages: Iterator[List[Dict]], fetch_body: bool) -> Iterator[Dict]:
+        """Fetch details one request per message from worker threads, in listing order.
+        
+        Requests are submitted while later pages are still being listed, with
+        at most MAX_IN_FLIGHT results waiting ahead of the consumer.
+        """
+        def fetch(msg_id):
+            return self._get_email_details(msg_id, self._thread_service(), fetch_body)
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            try:
+                for page in pages:
+                    for msg in page:
+                        if len(pending) >= self.MAX_IN_FLIGHT:
+                            yield pending.popleft().result()
+                        pending.append(executor.submit(fetch, msg['id']))
+                    # Hand over whatever has already finished before listing the next page
+                    while pending and pending[0].done():
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Don't start queued requests if the consumer stopped early or a fetch failed
+                for future in pending:
+                    future.cancel()
+
+    def _get_email_details_batch(self, msg_ids: List[str], fetch_body: bool = True) -> List[Dict]:
+        """Retrieve details for several emails in a single batched HTTP request."""
+        responses = {}
+        errors = {}
+
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                responses[request_id] = response
+
+        batch = self.service.new_batch_http_request(callback=on_response)
+        for msg_id in msg_ids:
+            batch.add(self._message_request(self.service, msg_id, fetch_body), request_id=msg_id)
+        batch.execute()
+
+        details = {msg_id: self._parse_message(msg_id, response) for msg_id, response in responses.items()}
+        # Large batches often have a few sub-requests rate limited; fetch those
+        # again one at a time, leaving the backoff to the client library
+        for msg_id, error in errors.items():
+            if not self._is_retryable(error):
+                raise GmailAPIError(f"Failed to get email details for message {msg_id}: {error}") from error
+            logging.warning("Retrying message %s after batch error: %s", msg_id, error)
+            details[msg_id] = self._get_email_details(msg_id, fetch_body=fetch_body, num_retries=self.MAX_RETRIES)
+
+        return [details[msg_id] for msg_id in msg_ids]
+
+    @classmethod
+    def _is_retryable(cls, error: Exception) -> bool:
+        """Return True if a failed request hit a rate limit or a transient server error."""
+        if not isinstance(error, HttpError):
+            return False
+        if error.resp.status == 403:
+            return any(reason in error.content for reason in cls.RATE_LIMIT_REASONS)
+        return error.resp.status in cls.RETRYABLE_STATUSES
+
+    def _message_request(self, service, msg_id: str, fetch_body: bool):
+        """Build a messages.get request for either the full message or just its headers."""
+        messages = service.users().messages()
+        if fetch_body:
+            # Get the full message including body content
+            return messages.get(userId='me', id=msg_id, format='full')
+        return messages.get(userId='me', id=msg_id, format='metadata', metadataHeaders=self.METADATA_HEADERS)
+
+    def _get_email_details(self, msg_id: str, service=None, fetch_body: bool = True,
+                           num_retries: int = 0) -> Dict:
         """Retrieve detailed metadata and content for a single email."""
+        service = service or self.service
         try:
-            # Get the full message including body content
-            msg = self.service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-            
-            if 'payload' not in msg or 'headers' not in msg['payload']:
-                logging.warning("Message %s has unexpected format, missing payload or headers", msg_id)
-                headers = {}
-                message_content = ""
-            else:
-                headers = {h['name'].lower(): h['value'] for h in msg['payload']['headers']}
-                message_content = self._get_message_content(msg)
-            
-            email_details = {
-                'message_id': msg_id,
-                'thread_id': msg.get('threadId', ''),
-                'from': headers.get('from', ''),
-                'subject': headers.get('subject', ''),
-                'date_received': headers.get('date', ''),
-                'labels': msg.get('labelIds', []),
-                'message': message_content
-            }
-
-            logging.debug("Successfully extracted details for message %s", msg_id)
-                
-            return email_details
+            msg = self._message_request(service, msg_id, fetch_body).execute(num_retries=num_retries)
+            return self._parse_message(msg_id, msg)
         except HttpError as e:
             raise GmailAPIError(f"Failed to get email details for message {msg_id}: {e}") from e
         except Exception as e:
             raise GmailAPIError(f"Unexpected error while getting email details for message {msg_id}: {e}") from e
+
+    def _parse_message(self, msg_id: str, msg: Dict) -> Dict:
+        """Build the email details dictionary from a messages.get response."""
+        if 'payload' not in msg or 'headers' not in msg['payload']:
+            logging.warning("Message %s has unexpected format, missing payload or headers", msg_id)
+            headers = {}
+            message_content = ""
+        else:
+            headers = {h['name'].lower(): h['value'] for h in msg['payload']['headers']}
+            message_content = self._get_message_content(msg)
+        
+        email_details = {
+            'message_id': msg_id,
+            'thread_id': msg.get('threadId', ''),
+            'from': headers.get('from', ''),
+            'subject': headers.get('subject', ''),
+            'date_received': headers.get('date', ''),
+            'labels': msg.get('labelIds', []),
+            'message': message_content
+        }
+
+        logging.debug("Successfully extracted details for message %s", msg_id)
+            
+        return email_details
             
     def _get_message_content(self, message: Dict) -> str:
         """Extract plain text content from a Gmail message."""
         if 'payload' not in message:
             return ""
             
-        payload = message['payload']
-        parts = [payload]  # Start with the main payload
-        body_data = ""
+        parts = deque([message['payload']])  # Start with the main payload
+        body_data = bytearray()
         
-        # Process parts recursively
+        # Walk the MIME tree breadth-first
         while parts:
-            part = parts.pop(0)
+            part = parts.popleft()
             
-            # Check if this part has a body
-            if 'body' in part and 'data' in part['body'] and part['body']['data']:
+            # Check if this part has a text body; inline images and other
+            # non-text data are skipped without being decoded
+            data = part.get('body', {}).get('data')
+            if data and part.get('mimeType', 'text/').startswith('text/'):
                 try:
-                    from base64 import urlsafe_b64decode
-                    import codecs
-                    
-                    # Decode body data
-                    body_bytes = urlsafe_b64decode(part['body']['data'])
-                    body_text = codecs.decode(body_bytes, 'utf-8', errors='replace')
-                    body_data += body_text
+                    body_data += urlsafe_b64decode(data)
                 except Exception as e:
                     logging.warning(f"Failed to decode message body: {e}")
             
             # Add nested parts to the queue
-            if 'parts' in part:
-                parts.extend(part['parts'])
+            parts.extend(part.get('parts', ()))
                 
-        return body_data
+        # Decode the accumulated bytes once instead of growing a string per part
+        return body_data.decode('utf-8', errors='replace')
 
     def modify_email(self, msg_id: str, add_labels: Optional[List[str]] = None,
                      remove_labels: Optional[List[str]] = None):
@@ -240,4 +392,22 @@ class GmailClient:
         except HttpError as e:
             raise GmailAPIError(f"Failed to modify email {msg_id}: {e}") from e
         except Exception as e:
-            raise GmailAPIError(f"Unexpected error while modifying email {msg_id}: {e}") from e
\ No newline at end of file
+            raise GmailAPIError(f"Unexpected error while modifying email {msg_id}: {e}") from e
+
+    def batch_modify_emails(self, msg_ids: List[str], add_labels: Optional[List[str]] = None,
+                            remove_labels: Optional[List[str]] = None):
+        """Apply the same label changes to many emails with messages.batchModify."""
+        body = {
+            'addLabelIds': add_labels or [],
+            'removeLabelIds': remove_labels or []
+        }
+        
+        for start in range(0, len(msg_ids), self.MODIFY_BATCH_SIZE):
+            chunk = msg_ids[start:start + self.MODIFY_BATCH_SIZE]
+            try:
+                self.service.users().messages().batchModify(userId='me', body={'ids': chunk, **body}).execute()
+                logging.info("Successfully modified %s emails with labels %s", len(chunk), body)
+            except HttpError as e:
+                raise GmailAPIError(f"Failed to modify {len(chunk)} emails: {e}") from e
+            except Exception as e:
+                raise GmailAPIError(f"Unexpected error while modifying {len(chunk)} emails: {e}") from e
@@ -1,4 +1,6 @@
 import argparse
+from collections import defaultdict
+from datetime import datetime
 
 from src.gmail_client import GmailClient
 from src.email_storage import EmailStorage
@@ -10,18 +12,33 @@ def main(look_back_days: int = 7):
     storage = EmailStorage('email.db')
     engine = RuleEngine('config/rules.json')
 
-    # Fetch emails (they are saved to database automatically during fetching)
-    emails = client.fetch_inbox_emails(look_back=look_back_days)
+    # Stream fetched emails through the rules and straight into the database,
+    # only downloading message bodies when a rule needs them
+    emails = client.fetch_inbox_emails(look_back=look_back_days, fetch_body=engine.needs_body())
+    label_changes = defaultdict(list)
+    storage.save_stream(process_emails(engine, emails, label_changes))
 
-    # Save to database immediately if we have storage
-    if storage:
-        storage.save_emails(emails)
+    # Apply each distinct set of label changes with as few API calls as possible
+    for (add_labels, remove_labels), msg_ids in label_changes.items():
+        client.batch_modify_emails(msg_ids, list(add_labels), list(remove_labels))
 
-    # Process emails with rules
-    for email in storage.get_all_emails():
-        actions = engine.evaluate(email)
+    storage.close()
+
+def process_emails(engine, emails, label_changes):
+    """Evaluate rules for each email as it passes through, then yield it for storage.
+    
+    Message IDs are grouped in label_changes by the (add, remove) labels
+    their actions require, so they can be modified in bulk afterwards.
+    """
+    now = datetime.now()  # One reference time for every email in this run
+    for email in emails:
+        actions = engine.evaluate(email, now=now)
         if actions:
-            engine.apply_actions(client, email[0],email[5], actions)
+            add_labels, remove_labels = engine.plan_actions(email['labels'], actions)
+            if add_labels or remove_labels:
+                key = (tuple(sorted(set(add_labels))), tuple(sorted(set(remove_labels))))
+                label_changes[key].append(email['message_id'])
+        yield email
 
 def positive_int(value):
     """Validator to ensure value is a positive integer"""
@@ -30,14 +47,16 @@ def positive_int(value):
         raise argparse.ArgumentTypeError(f"--look-back must be a positive integer, got {value}")
     return ivalue
 
-if __name__ == '__main__':
-    # Set up command-line argument parsing
+def _build_parser():
+    """Build the command-line argument parser."""
     parser = argparse.ArgumentParser(description='Gmail processor script')
     parser.add_argument('--look-back', type=positive_int, default=7, 
                       help='Number of days to look back for emails (must be positive, default: 7 days)')
-    
+    return parser
+
+if __name__ == '__main__':
     # Parse arguments
-    args = parser.parse_args()
+    args = _build_parser().parse_args()
     
     # Run main function with provided or default look_back days
     main(args.look_back)
@@ -1,8 +1,45 @@
 import json
 from datetime import datetime, timedelta
-from typing import Dict, List, Callable, Union
+from operator import gt, itemgetter, lt
+from typing import Dict, List, Callable, Optional, Tuple, Union
 import logging
 
+from src.date_utils import header_timestamp
+
+def _move_message(action: Dict, labels: List[str]) -> Tuple[List[str], List[str]]:
+    """Add the target mailbox label unless the message already has it."""
+    if action['mailbox'] not in labels:
+        return [action['mailbox']], []
+    logging.info(f"Skipping move to {action['mailbox']} as message already has this label")
+    return [], []
+
+def _mark_read(action: Dict, labels: List[str]) -> Tuple[List[str], List[str]]:
+    """Remove the UNREAD label if present."""
+    if 'UNREAD' in labels:
+        return [], ['UNREAD']
+    logging.info("Skipping mark_read as message is already read")
+    return [], []
+
+def _mark_unread(action: Dict, labels: List[str]) -> Tuple[List[str], List[str]]:
+    """Add the UNREAD label if missing."""
+    if 'UNREAD' not in labels:
+        return ['UNREAD'], []
+    logging.info("Skipping mark_unread as message is already unread")
+    return [], []
+
+class _KeywordHits(dict):
+    """Rule keywords found in each text field of one email, scanned on first lookup."""
+
+    def __init__(self, fields: Tuple, keywords: Dict[str, set]):
+        super().__init__()
+        self._fields = fields
+        self._keywords = keywords
+
+    def __missing__(self, field: str) -> frozenset:
+        value = RuleEngine.FIELD_GETTERS[field](self._fields)
+        hits = self[field] = RuleEngine._find_keywords(value, self._keywords[field])
+        return hits
+
 class RuleEngine:
     """Evaluates rules and applies actions to emails."""
 
@@ -19,8 +56,64 @@ class RuleEngine:
         'greater_than_days': lambda age, days: age > timedelta(days=int(days))
     }
 
+    # Positions of each rule field in the tuple built by _extract_fields
+    FIELD_GETTERS: Dict[str, Callable] = {
+        'from': itemgetter(0),
+        'subject': itemgetter(1),
+        'date_received': itemgetter(2),  # Age of the email as a timedelta
+        'message': itemgetter(3)
+    }
+
+    # Substring predicates on text fields are answered from the set of rule
+    # keywords found in that field, which is computed once per email
+    KEYWORD_PREDICATES: Dict[str, Callable] = {
+        'contains': lambda hits, target: target in hits,
+        'does_not_contain': lambda hits, target: target not in hits
+    }
+
+    # Date predicates on the email's age, compared against a timedelta threshold
+    # built once when the rules are compiled
+    DATE_PREDICATES: Dict[str, Callable] = {
+        'less_than_days': lt,
+        'greater_than_days': gt
+    }
+
+    # Each text field's keyword hits, looked up in the _KeywordHits that evaluate
+    # appends to the field tuple
+    KEYWORD_GETTERS: Dict[str, Callable] = {
+        'from': lambda fields: fields[4]['from'],
+        'subject': lambda fields: fields[4]['subject'],
+        'message': lambda fields: fields[4]['message']
+    }
+
+    # Action handlers, each returning the (add, remove) label changes for an email
+    ACTION_HANDLERS: Dict[str, Callable] = {
+        'move_message': _move_message,
+        'mark_read': _mark_read,
+        'mark_unread': _mark_unread
+    }
+
+    # Rule modes and how they combine condition results
+    MODES: Dict[str, Callable] = {
+        'all': all,
+        'any': any
+    }
+
     def __init__(self, rules_path: str):
-        self.rules = self._load_rules(rules_path)
+        self._set_rules(self._load_rules(rules_path))
+
+    @classmethod
+    def from_rules(cls, rules: List[Dict]) -> 'RuleEngine':
+        """Create an engine from a list of rules already in memory."""
+        engine = cls.__new__(cls)
+        engine._set_rules(rules)
+        return engine
+
+    def _set_rules(self, rules: List[Dict]):
+        """Store the rules and compile them for evaluation."""
+        self.rules = rules
+        self._keywords: Dict[str, set] = {field: set() for field in self.KEYWORD_GETTERS}
+        self._compiled = self._compile_rules(self.rules)
 
     def _load_rules(self, rules_path: str) -> List[Dict]:
         """Load rules from a JSON file."""
@@ -38,15 +131,101 @@ class RuleEngine:
             logging.error(f"Invalid JSON in {rules_path}: {e}. No rules will be applied.")
             return []
 
-    def evaluate(self, email: Union[tuple, Dict]) -> List[Dict]:
+    def _compile_rules(self, rules: List[Dict]) -> List[Tuple[Callable, List[Tuple], List[Dict]]]:
+        """Resolve field getters and predicates once so evaluation avoids per-email lookups.
+        
+        Returns:
+            List of (mode function, [(getter, predicate, target), ...], actions) tuples
+        """
+        compiled = []
+        body_getters = self._body_getters()
+        for rule in rules:
+            # Extract rule mode (default to 'all' if not specified)
+            rule_mode = rule.get('mode', 'all').lower()
+            mode_fn = self.MODES.get(rule_mode)
+            if mode_fn is None:
+                logging.warning(f"Unknown rule mode: {rule_mode}")
+                continue
+            
+            conditions = []
+            for cond in rule['conditions']:
+                field_name = cond['field'].lower()
+                predicate_name = cond['predicate']
+                if field_name not in self.FIELD_GETTERS:
+                    logging.warning(f"Unknown field name: {field_name}")
+                elif predicate_name not in self.PREDICATES:
+                    logging.warning(f"Unknown predicate: {predicate_name}")
+                elif predicate_name in self.KEYWORD_PREDICATES and not isinstance(cond['value'], str):
+                    logging.warning(f"Invalid value for {predicate_name}: {cond['value']!r}")
+                elif predicate_name in self.KEYWORD_PREDICATES and field_name in self.KEYWORD_GETTERS:
+                    self._keywords[field_name].add(cond['value'])
+                    conditions.append((self.KEYWORD_GETTERS[field_name], self.KEYWORD_PREDICATES[predicate_name], cond['value']))
+                    continue
+                elif predicate_name in self.DATE_PREDICATES and field_name == 'date_received':
+                    threshold = timedelta(days=int(cond['value']))
+                    conditions.append((self.FIELD_GETTERS[field_name], self.DATE_PREDICATES[predicate_name], threshold))
+                    continue
+                else:
+                    conditions.append((self.FIELD_GETTERS[field_name], self.PREDICATES[predicate_name], cond['value']))
+                    continue
+                
+                if mode_fn is all:
+                    # An invalid condition can never be satisfied, so neither can the rule
+                    break
+                # In 'any' mode, skip this condition but keep checking the others
+            else:
+                # Check header conditions first so the rule can be settled before
+                # the message body is scanned; the predicates are pure, so order
+                # does not change the result
+                conditions.sort(key=lambda cond: cond[0] in body_getters)
+                compiled.append((mode_fn, conditions, rule['actions']))
+                
+        return compiled
+
+    @classmethod
+    def _body_getters(cls) -> Tuple[Callable, Callable]:
+        """Return the getters that read the message body."""
+        return cls.FIELD_GETTERS['message'], cls.KEYWORD_GETTERS['message']
+
+    def needs_body(self) -> bool:
+        """Return True if any rule inspects the message body."""
+        body_getters = self._body_getters()
+        return any(getter in body_getters
+                   for _, conditions, _ in self._compiled
+                   for getter, _, _ in conditions)
+
+    def evaluate(self, email: Union[tuple, Dict], now: Optional[datetime] = None) -> List[Dict]:
         """Return actions for an email if rule conditions are met.
         
         Args:
             email: Email data as a tuple from database or as a dictionary
+            now: Reference time for date conditions; pass the same value when
+                evaluating many emails to avoid reading the clock for each one
             
         Returns:
             List of applicable actions for this email
         """
+        fields = self._extract_fields(email, now or datetime.now())
+        # Each text field is scanned for all its rule keywords at once, but only
+        # when a condition first needs it
+        fields += (_KeywordHits(fields, self._keywords),)
+        applicable_actions = []
+
+        for mode_fn, conditions, actions in self._compiled:
+            if mode_fn(predicate_fn(getter(fields), target) for getter, predicate_fn, target in conditions):
+                applicable_actions.extend(actions)
+                
+        return applicable_actions
+
+    @staticmethod
+    def _find_keywords(value: str, keywords: set) -> frozenset:
+        """Return the keywords that occur in a field value."""
+        if not value or not keywords:
+            return frozenset()
+        return frozenset(keyword for keyword in keywords if keyword in value)
+
+    def _extract_fields(self, email: Union[tuple, Dict], now: datetime) -> Tuple[str, str, timedelta, str]:
+        """Normalize an email into the (from, subject, age, message) tuple used by FIELD_GETTERS."""
         # Handle email as tuple from database or as dictionary
         if isinstance(email, tuple):
             _, _, from_email, subject, date_received, _, message_content = email
@@ -55,115 +234,48 @@ class RuleEngine:
             # If it's a dictionary with full email details
             from_email = email.get('from', '')
             subject = email.get('subject', '')
-            date_received = email.get('date_received', datetime.now())
+            date_received = email.get('date_received', now)
             if isinstance(date_received, str):
-                # Convert string to datetime if needed
-                try:
-                    date_received = datetime.fromisoformat(date_received.replace('Z', '+00:00'))
-                except ValueError:
-                    date_received = datetime.now()
+                date_received = self._parse_date(date_received)
             message_content = email.get('message', '')
             
-        applicable_actions = []
+        return from_email, subject, now - date_received, message_content
 
-        for rule in self.rules:
-            # Extract rule mode (default to 'all' if not specified)
-            rule_mode = rule.get('mode', 'all').lower()
-            
-            # Check if conditions are met based on the rule mode
-            if rule_mode == 'all' and self._all_conditions_met(from_email, subject, date_received, message_content, rule['conditions']):
-                applicable_actions.extend(rule['actions'])
-            elif rule_mode == 'any' and self._any_conditions_met(from_email, subject, date_received, message_content, rule['conditions']):
-                applicable_actions.extend(rule['actions'])
-                
-        return applicable_actions
+    @staticmethod
+    def _parse_date(date_str: str) -> datetime:
+        """Convert a Date header (RFC 2822) or ISO string to a naive local datetime."""
+        try:
+            # Same parsing as storage, so rules and the database agree on the time
+            return datetime.fromtimestamp(header_timestamp(date_str))
+        except (TypeError, ValueError, IndexError):
+            try:
+                date_received = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+            except ValueError:
+                return datetime.now()
+        if date_received.tzinfo is not None:
+            # Compare in local time, like timestamps loaded from the database
+            date_received = datetime.fromtimestamp(date_received.timestamp())
+        return date_received
 
-    def _all_conditions_met(self, from_email: str, subject: str, date_received: datetime, 
-                           message_content: str, conditions: List[Dict]) -> bool:
-        """Check if ALL conditions in a rule are satisfied."""
-        now = datetime.now()
-        for cond in conditions:
-            # Get the appropriate value based on the field
-            field_name = cond['field'].lower()
-            if field_name == 'from':
-                field_value = from_email
-            elif field_name == 'subject':
-                field_value = subject
-            elif field_name == 'message':
-                field_value = message_content
-            elif field_name == 'date_received':
-                field_value = now - date_received
-            else:
-                logging.warning(f"Unknown field name: {field_name}")
-                return False
-                
-            # Get the predicate function
-            predicate_name = cond['predicate']
-            if predicate_name not in self.PREDICATES:
-                logging.warning(f"Unknown predicate: {predicate_name}")
-                return False
-                
-            predicate_fn = self.PREDICATES[predicate_name]
-            
-            # Check if the condition is met
-            if not predicate_fn(field_value, cond['value']):
-                return False
-                
-        return True
-        
-    def _any_conditions_met(self, from_email: str, subject: str, date_received: datetime, 
-                           message_content: str, conditions: List[Dict]) -> bool:
-        """Check if ANY condition in a rule is satisfied."""
-        now = datetime.now()
+    @staticmethod
+    def plan_actions(labels: List[str], actions: List[Dict]) -> Tuple[List[str], List[str]]:
+        """Work out the label changes needed to apply actions to an email.
         
-        if not conditions:  # If there are no conditions, return False
-            return False
-            
-        for cond in conditions:
-            # Get the appropriate value based on the field
-            field_name = cond['field'].lower()
-            if field_name == 'from':
-                field_value = from_email
-            elif field_name == 'subject':
-                field_value = subject
-            elif field_name == 'message':
-                field_value = message_content
-            elif field_name == 'date_received':
-                field_value = now - date_received
-            else:
-                logging.warning(f"Unknown field name: {field_name}")
-                continue  # Skip this condition but continue checking others
-                
-            # Get the predicate function
-            predicate_name = cond['predicate']
-            if predicate_name not in self.PREDICATES:
-                logging.warning(f"Unknown predicate: {predicate_name}")
-                continue  # Skip this condition but continue checking others
-                
-            predicate_fn = self.PREDICATES[predicate_name]
-            
-            # If any condition is met, return True
-            if predicate_fn(field_value, cond['value']):
-                return True
-                
-        return False
+        Returns:
+            Tuple of (labels to add, labels to remove)
+        """
+        add_labels, remove_labels = [], []
+        for action in actions:
+            handler = RuleEngine.ACTION_HANDLERS.get(action['type'])
+            if handler:
+                add, remove = handler(action, labels)
+                add_labels += add
+                remove_labels += remove
+        return add_labels, remove_labels
 
     @staticmethod
     def apply_actions(client, msg_id: str, labels: List[str], actions: List[Dict]):
         """Apply actions to an email via the Gmail client."""
-        add_labels, remove_labels = [], []
-        for action in actions:
-            if action['type'] == 'move_message' and action['mailbox'] not in labels:
-                add_labels.append(action['mailbox'])
-            elif action['type'] == 'move_message':
-                logging.info(f"Skipping move to {action['mailbox']} as message already has this label")
-            elif action['type'] == 'mark_read' and 'UNREAD' in labels:
-                remove_labels.append('UNREAD')
-            elif action['type'] == 'mark_read':
-                logging.info("Skipping mark_read as message is already read")
-            elif action['type'] == 'mark_unread' and 'UNREAD' not in labels:
-                add_labels.append('UNREAD')
-            elif action['type'] == 'mark_unread':
-                logging.info("Skipping mark_unread as message is already unread")
+        add_labels, remove_labels = RuleEngine.plan_actions(labels, actions)
         if add_labels or remove_labels:
-            client.modify_email(msg_id, add_labels, remove_labels)
\ No newline at end of file
+            client.modify_email(msg_id, add_labels, remove_labels)
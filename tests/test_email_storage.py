@@ -1,45 +1,49 @@
 import unittest
-import os
-import sqlite3
 import json
+from unittest.mock import patch
 from datetime import datetime
 from src.email_storage import EmailStorage
 
+# Sample email data with message content
+_SAMPLE_EMAIL = {
+    'message_id': 'test-msg-001',
+    "thread_id": "test-thread-001",
+    'from': 'sender@example.com',
+    'subject': 'Test Email Subject',
+    'date_received': 'Mon, 22 Mar 2025 10:00:00 +0000',
+    'labels': ['INBOX', 'UNREAD'],
+    'message': 'This is the body content of the test email message.'
+}
+
 class TestEmailStorage(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Share one in-memory database across the class instead of reopening
+        # SQLite and recreating the schema for every test
+        cls.storage = EmailStorage(':memory:')
+        cls.addClassCleanup(cls.storage.close)
+
     def setUp(self):
-        # Use a test database file
-        self.test_db_path = 'test_email.db'
-        
-        # Create a new storage instance for each test
-        self.storage = EmailStorage(self.test_db_path)
-        
-        # Sample email data with message content
-        self.sample_email = {
-            'message_id': 'test-msg-001',
-            "thread_id": "test-thread-001",
-            'from': 'sender@example.com',
-            'subject': 'Test Email Subject',
-            'date_received': 'Mon, 22 Mar 2025 10:00:00 +0000',
-            'labels': ['INBOX', 'UNREAD'],
-            'message': 'This is the body content of the test email message.'
-        }
-        
-    def tearDown(self):
-        # Clean up the test database after each test
-        if os.path.exists(self.test_db_path):
-            os.remove(self.test_db_path)
-    
+        # Start each test from an empty table
+        self.storage.conn.execute("DELETE FROM emails")
+        
+        # Shared sample email; tests copy it before making changes
+        self.sample_email = _SAMPLE_EMAIL
+        
     def test_db_initialization(self):
         """Test that the database is properly initialized with the expected schema."""
-        # Connect directly to the database to check schema
-        with sqlite3.connect(self.test_db_path) as conn:
-            cursor = conn.execute("PRAGMA table_info(emails)")
-            columns = {info[1] for info in cursor.fetchall()}
-            
-            # Check that all expected columns exist
-            expected_columns = {'message_id', 'thread_id', 'from_email', 'subject', 'date_received', 'labels', 'message'}
-            for col in expected_columns:
-                self.assertIn(col, columns, f"Column {col} is missing from the schema")
+        # Inspect the schema through the storage's own connection
+        cursor = self.storage.conn.execute("PRAGMA table_info(emails)")
+        columns = {info[1] for info in cursor.fetchall()}
+        
+        # Check that all expected columns exist
+        expected_columns = {'message_id', 'thread_id', 'from_email', 'subject', 'date_received', 'labels', 'message'}
+        self.assertTrue(expected_columns <= columns, f"Columns missing from the schema: {expected_columns - columns}")
+        
+        # Check that the secondary indexes used by date and thread queries exist
+        expected_indexes = {'idx_date_received', 'idx_thread_id'}
+        indexes = {row[1] for row in self.storage.conn.execute("PRAGMA index_list(emails)")}
+        self.assertTrue(expected_indexes <= indexes, f"Indexes missing from the schema: {expected_indexes - indexes}")
     
     def test_save_and_retrieve_email_with_message(self):
         """Test saving and retrieving an email with message content."""
@@ -65,6 +69,7 @@ class TestEmailStorage(unittest.TestCase):
         self.assertEqual(subject, self.sample_email['subject'])
         self.assertEqual(date_received, timestamp)
         self.assertEqual(json.loads(labels_json), self.sample_email['labels'])
+        self.assertEqual(labels_json, '["INBOX","UNREAD"]')  # Compact encoding, no spaces
         self.assertEqual(message, self.sample_email['message'])
     
     def test_multiple_emails_storage(self):
@@ -105,6 +110,143 @@ class TestEmailStorage(unittest.TestCase):
             self.assertIn(email['message'], message_contents, 
                          f"Message content '{email['message']}' not found in stored emails")
     
+    def test_resave_only_updates_changed_labels(self):
+        """Test that saving an unchanged email again writes nothing."""
+        self.storage.save_email(self.sample_email)
+        
+        # Same labels in a different order are not a change
+        email = self.sample_email.copy()
+        email['labels'] = ['UNREAD', 'INBOX']
+        changes_before = self.storage.conn.total_changes
+        self.storage.save_email(email)
+        self.assertEqual(self.storage.conn.total_changes, changes_before)
+        
+        # Changed labels are updated
+        email['labels'] = ['INBOX']
+        self.storage.save_email(email)
+        labels_json = self.storage.get_all_emails()[0][5]
+        self.assertEqual(json.loads(labels_json), ['INBOX'])
+    
+    def test_resave_fills_in_missing_message(self):
+        """Test that an email stored without its body gets it on a later save."""
+        email = self.sample_email.copy()
+        email['message'] = ''
+        self.storage.save_email(email)
+        
+        # A later sync that downloaded the body fills it in
+        self.storage.save_email(self.sample_email)
+        self.assertEqual(self.storage.get_all_emails()[0][6], self.sample_email['message'])
+        
+        # A sync without bodies does not clear a stored one
+        self.storage.save_email(email)
+        self.assertEqual(self.storage.get_all_emails()[0][6], self.sample_email['message'])
+    
+    def test_save_stream(self):
+        """Test storing emails from a generator across several chunks."""
+        def generate_emails():
+            for i in range(5):
+                email = self.sample_email.copy()
+                email['message_id'] = f"stream-msg-{i}"
+                yield email
+        
+        # Use a chunk size that does not divide evenly to exercise the final partial chunk
+        count = self.storage.save_stream(generate_emails(), chunk_size=2)
+        
+        self.assertEqual(count, 5)
+        stored_ids = {email[0] for email in self.storage.get_all_emails()}
+        self.assertEqual(stored_ids, {f"stream-msg-{i}" for i in range(5)})
+    
+    def test_save_stream_into_empty_table_defers_date_index(self):
+        """Test that a first sync builds the date index once, even if the stream fails."""
+        def index_names():
+            return {row[1] for row in self.storage.conn.execute("PRAGMA index_list(emails)")}
+        
+        seen_indexes = []
+        def generate_emails():
+            for i in range(3):
+                seen_indexes.append(index_names())
+                email = self.sample_email.copy()
+                email['message_id'] = f"first-sync-msg-{i}"
+                yield email
+            raise RuntimeError("fetch failed")
+        
+        with self.assertRaises(RuntimeError):
+            self.storage.save_stream(generate_emails(), chunk_size=2)
+        
+        # The date index was absent while rows were written and is back afterwards
+        self.assertTrue(all('idx_date_received' not in names for names in seen_indexes))
+        self.assertIn('idx_date_received', index_names())
+        self.assertEqual(self.storage.get_email_count(), 2)  # The completed chunk was kept
+    
+    def test_bulk_load(self):
+        """Test bulk loading emails keeps the secondary indexes in place."""
+        emails = []
+        # More than one multi-row INSERT worth, plus a remainder
+        for i in range(300):
+            email = self.sample_email.copy()
+            email['message_id'] = f"bulk-msg-{i}"
+            emails.append(email)
+        
+        self.storage.bulk_load(emails)
+        
+        self.assertEqual(len(self.storage.get_all_emails()), 300)
+        indexes = {row[1] for row in self.storage.conn.execute("PRAGMA index_list(emails)")}
+        self.assertTrue({'idx_date_received', 'idx_thread_id'} <= indexes)
+    
+    def test_large_save_emails_uses_bulk_load(self):
+        """Test that batches over the threshold are saved through bulk_load."""
+        emails = []
+        for i in range(EmailStorage.BULK_LOAD_THRESHOLD + 1):
+            email = self.sample_email.copy()
+            email['message_id'] = f"large-msg-{i}"
+            emails.append(email)
+        
+        with patch.object(self.storage, 'bulk_load', wraps=self.storage.bulk_load) as bulk_load:
+            self.storage.save_emails(emails)
+            bulk_load.assert_called_once_with(emails)
+        self.assertEqual(len(self.storage.get_all_emails()), len(emails))
+    
+    def test_large_save_emails_into_larger_table(self):
+        """Test that a large batch into a larger table is inserted without rebuilding indexes."""
+        count = EmailStorage.BULK_LOAD_THRESHOLD + 1
+        existing = []
+        for i in range(count + 1):
+            email = self.sample_email.copy()
+            email['message_id'] = f"existing-msg-{i}"
+            existing.append(email)
+        self.storage.bulk_load(existing)
+        
+        emails = []
+        for i in range(count):
+            email = self.sample_email.copy()
+            email['message_id'] = f"new-msg-{i}"
+            emails.append(email)
+        
+        with patch.object(self.storage, 'bulk_load') as bulk_load:
+            self.storage.save_emails(emails)
+            bulk_load.assert_not_called()
+        self.assertEqual(self.storage.get_email_count(), len(existing) + len(emails))
+        indexes = {row[1] for row in self.storage.conn.execute("PRAGMA index_list(emails)")}
+        self.assertTrue({name for name, _ in EmailStorage._INDEXES} <= indexes)
+    
+    def test_iter_emails(self):
+        """Test lazily iterating over stored emails."""
+        self.storage.save_email(self.sample_email)
+        
+        rows = self.storage.iter_emails()
+        
+        # Rows are produced on demand rather than returned as a list
+        self.assertNotIsInstance(rows, list)
+        self.assertEqual([row[0] for row in rows], [self.sample_email['message_id']])
+    
+    def test_get_email_count(self):
+        """Test counting stored emails."""
+        self.assertEqual(self.storage.get_email_count(), 0)
+        
+        self.storage.save_email(self.sample_email)
+        
+        self.assertEqual(self.storage.get_email_count(), 1)
+    
     def test_date_parsing_formats(self):
         """Test that various date formats are parsed correctly."""
         # Test different date formats
@@ -1,40 +1,76 @@
 import unittest
+import copy
 from unittest.mock import patch, MagicMock, Mock
 import os
+import tempfile
 import json
+import threading
 from datetime import datetime, timedelta
 from googleapiclient.errors import HttpError
 from src.gmail_client import GmailClient, GmailAPIError
 
+# Sample email data for testing
+_SAMPLE_MESSAGE = {
+    'id': 'test-msg-001',
+    'threadId': 'test-thread-001',
+    'labelIds': ['INBOX', 'UNREAD'],
+    'payload': {
+        'headers': [
+            {'name': 'From', 'value': 'sender@example.com'},
+            {'name': 'Subject', 'value': 'Test Email Subject'},
+            {'name': 'Date', 'value': 'Mon, 22 Mar 2025 10:00:00 +0000'}
+        ],
+        'body': {
+            'data': 'VGhpcyBpcyBhIHRlc3QgbWVzc2FnZSBib2R5Lg=='  # "This is a test message body." in base64
+        }
+    }
+}
+
+
+class FakeBatchHttpRequest:
+    """Stand-in for BatchHttpRequest that runs the queued requests on execute().
+    
+    Requests whose ID is in errors report that exception instead of running.
+    """
+
+    def __init__(self, callback=None, errors=None):
+        self.callback = callback
+        self.requests = []
+        self.errors = errors or {}
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            if request_id in self.errors:
+                self.callback(request_id, None, self.errors[request_id])
+            else:
+                self.callback(request_id, request.execute(), None)
+
 
 class TestGmailClient(unittest.TestCase):
     """Tests for the Gmail Client component."""
 
+    @classmethod
+    def setUpClass(cls):
+        """Create a client prototype once, without going through authentication."""
+        cls._proto_client = GmailClient.__new__(GmailClient)
+        cls._proto_client.credentials = None
+        
+        # Token files written by the authentication tests go here and are
+        # removed together when the class finishes
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(cls.tmpdir.cleanup)
+
     def setUp(self):
         """Set up test environment."""
-        # Create test credentials and token paths
-        self.test_credentials_path = 'test_credentials.json'
-        self.test_token_path = 'test_token.json'
-        
-        # Mock storage
-        self.mock_storage = MagicMock()
-        
-        # Create sample email data for testing
-        self.sample_message = {
-            'id': 'test-msg-001',
-            'threadId': 'test-thread-001',
-            'labelIds': ['INBOX', 'UNREAD'],
-            'payload': {
-                'headers': [
-                    {'name': 'From', 'value': 'sender@example.com'},
-                    {'name': 'Subject', 'value': 'Test Email Subject'},
-                    {'name': 'Date', 'value': 'Mon, 22 Mar 2025 10:00:00 +0000'}
-                ],
-                'body': {
-                    'data': 'VGhpcyBpcyBhIHRlc3QgbWVzc2FnZSBib2R5Lg=='  # "This is a test message body." in base64
-                }
-            }
-        }
+        # Create test credentials and token paths, unique to each test
+        self.test_credentials_path = os.path.join(self.tmpdir.name, f"credentials_{self.id()}.json")
+        self.test_token_path = os.path.join(self.tmpdir.name, f"token_{self.id()}.json")
+        
+        # Shared sample email data; tests only read it
+        self.sample_message = _SAMPLE_MESSAGE
         
         # Sample response for list messages
         self.list_messages_response = {
@@ -52,13 +88,22 @@ class TestGmailClient(unittest.TestCase):
             ]
         }
         
-    def tearDown(self):
-        """Clean up after tests."""
-        # Remove test files if they exist
-        for file_path in [self.test_credentials_path, self.test_token_path]:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
+        # Mock Gmail service; the users().messages() chain is resolved once so
+        # tests configure and assert against it directly
+        self.mock_service = MagicMock()
+        self.mock_service.new_batch_http_request.side_effect = FakeBatchHttpRequest
+        self.messages_api = self.mock_service.users.return_value.messages.return_value
+        self.messages_api.list.return_value.execute.side_effect = [
+            self.list_messages_response,
+            self.list_messages_response_last_page
+        ]
+        self.messages_api.get.return_value.execute.return_value = self.sample_message
+        
+        # Copy the prototype client; only the authentication tests construct one
+        self.client = copy.copy(self._proto_client)
+        self.client.service = self.mock_service
+        self.client._local = threading.local()
+        
     @patch('src.gmail_client.build')
     @patch('src.gmail_client.Credentials')
     @patch('src.gmail_client.InstalledAppFlow')
@@ -72,13 +117,14 @@ class TestGmailClient(unittest.TestCase):
             f.write('{}')
         
         # Create the client
-        client = GmailClient(self.test_credentials_path, self.test_token_path, self.mock_storage)
+        client = GmailClient(self.test_credentials_path, self.test_token_path)
         
         # Verify token was loaded
         mock_credentials.from_authorized_user_file.assert_called_once_with(self.test_token_path, GmailClient.SCOPES)
         
-        # Verify service was built
+        # Verify service was built without the discovery cache
         mock_build.assert_called_once()
+        self.assertIs(mock_build.call_args.kwargs['cache_discovery'], False)
 
     @patch('src.gmail_client.build')
     @patch('src.gmail_client.Credentials')
@@ -94,7 +140,7 @@ class TestGmailClient(unittest.TestCase):
             f.write('{}')
         
         # Create the client
-        client = GmailClient(self.test_credentials_path, self.test_token_path, self.mock_storage)
+        client = GmailClient(self.test_credentials_path, self.test_token_path)
         
         # Verify token was refreshed
         mock_creds.refresh.assert_called_once()
@@ -115,103 +161,126 @@ class TestGmailClient(unittest.TestCase):
         mock_credentials.from_authorized_user_file.side_effect = Exception("File not found")
         
         # Create the client
-        client = GmailClient(self.test_credentials_path, self.test_token_path, self.mock_storage)
+        client = GmailClient(self.test_credentials_path, self.test_token_path)
         
         # Verify flow was created and run
         mock_flow.from_client_secrets_file.assert_called_once_with(self.test_credentials_path, GmailClient.SCOPES)
         mock_flow_instance.run_local_server.assert_called_once()
 
-    @patch('src.gmail_client.build')
-    def test_fetch_inbox_emails(self, mock_build):
+    def test_fetch_inbox_emails(self):
         """Test fetching emails from inbox."""
-        # Create mock service
-        mock_service = MagicMock()
-        mock_build.return_value = mock_service
-        
-        # Mock messages.list API call
-        mock_list = MagicMock()
-        mock_list.execute.side_effect = [
-            self.list_messages_response,
-            self.list_messages_response_last_page
-        ]
-        mock_service.users().messages().list.return_value = mock_list
-        
-        # Mock messages.get API call
-        mock_get = MagicMock()
-        mock_get.execute.return_value = self.sample_message
-        mock_service.users().messages().get.return_value = mock_get
-        
-        # Create client without going through authentication
-        client = GmailClient.__new__(GmailClient)
-        client.service = mock_service
-        client.email_storage = self.mock_storage
-        
         # Call the method
-        emails = client.fetch_inbox_emails()
+        emails = list(self.client.fetch_inbox_emails())
         
         # Verify API calls
-        mock_service.users().messages().list.assert_called()
-        self.assertEqual(mock_service.users().messages().get.call_count, 3)  # 3 messages total
+        self.messages_api.list.assert_called()
+        self.assertEqual(self.messages_api.get.call_count, 3)  # 3 messages total
         
-        # Verify storage calls
-        self.assertEqual(self.mock_storage.save_email.call_count, 3)
+        # Verify all details were fetched in a single batch request
+        self.assertEqual(self.mock_service.new_batch_http_request.call_count, 1)
         
         # Verify emails data
         self.assertEqual(len(emails), 3)
 
+    def test_fetch_inbox_emails_batch_size(self):
+        """Test that details are requested in batches of at most BATCH_SIZE calls."""
+        # A single page listing more messages than fit in two batches
+        message_count = GmailClient.BATCH_SIZE * 2 + 50
+        self.messages_api.list.return_value.execute.side_effect = [
+            {'messages': [{'id': f'msg-{i:03d}'} for i in range(message_count)]}
+        ]
+        batches = []
+        def new_batch(callback=None):
+            batches.append(FakeBatchHttpRequest(callback))
+            return batches[-1]
+        self.mock_service.new_batch_http_request.side_effect = new_batch
+
+        emails = list(self.client.fetch_inbox_emails())
+
+        # Verify the calls were split into full batches plus a remainder, in order
+        self.assertEqual([len(batch.requests) for batch in batches], [100, 100, 50])
+        self.assertEqual([email['message_id'] for email in emails],
+                         [f'msg-{i:03d}' for i in range(message_count)])
+
+    def test_fetch_inbox_emails_retries_rate_limited_batch_calls(self):
+        """Test that messages rate limited inside a batch are fetched again on their own."""
+        mock_resp = MagicMock(status=429, reason='Too Many Requests')
+        rate_limited = {'msg-002': HttpError(mock_resp, b'rateLimitExceeded')}
+        self.mock_service.new_batch_http_request.side_effect = (
+            lambda callback=None: FakeBatchHttpRequest(callback, errors=rate_limited))
+        
+        emails = list(self.client.fetch_inbox_emails())
+        
+        # The sync carries on, in listing order, with the failed message retried
+        self.assertEqual([email['message_id'] for email in emails], ['msg-001', 'msg-002', 'msg-003'])
+        self.messages_api.get.return_value.execute.assert_called_with(num_retries=GmailClient.MAX_RETRIES)
+    
+    def test_fetch_inbox_emails_batch_call_not_retryable(self):
+        """Test that a batch call failing with a non-retryable error is raised."""
+        mock_resp = MagicMock(status=404, reason='Not Found')
+        not_found = {'msg-002': HttpError(mock_resp, b'Requested entity was not found.')}
+        self.mock_service.new_batch_http_request.side_effect = (
+            lambda callback=None: FakeBatchHttpRequest(callback, errors=not_found))
+        
+        with self.assertRaises(GmailAPIError) as cm:
+            list(self.client.fetch_inbox_emails())
+        self.assertIn('msg-002', str(cm.exception))
+    
     @patch('src.gmail_client.build')
-    def test_fetch_inbox_emails_with_look_back(self, mock_build):
-        """Test fetching emails with look-back period."""
-        # Create mock service
-        mock_service = MagicMock()
-        mock_build.return_value = mock_service
+    def test_fetch_inbox_emails_without_batch(self, mock_build):
+        """Test fetching emails with per-message requests from worker threads."""
+        # The mock service is also returned for each worker thread
+        mock_build.return_value = self.mock_service
+        self.client.credentials = MagicMock()
         
-        # Mock messages.list API call
-        mock_list = MagicMock()
-        mock_list.execute.return_value = self.list_messages_response_last_page
-        mock_service.users().messages().list.return_value = mock_list
+        # Call the method
+        emails = list(self.client.fetch_inbox_emails(use_batch=False))
+        
+        # Verify each message was fetched individually, in order
+        self.assertEqual(self.messages_api.get.call_count, 3)
+        self.mock_service.new_batch_http_request.assert_not_called()
+        self.assertEqual(len(emails), 3)
+        self.assertEqual([email['message_id'] for email in emails], ['msg-001', 'msg-002', 'msg-003'])
+
+    def test_fetch_inbox_emails_overlaps_paging(self):
+        """Test that details for a page are fetched before the next page is listed."""
+        # A full batch on the first page, with more pages to follow
+        mock_list = self.messages_api.list.return_value
+        mock_list.execute.side_effect = [
+            {'messages': [{'id': f'msg-{i:03d}'} for i in range(GmailClient.BATCH_SIZE)],
+             'nextPageToken': 'next-page-token'},
+            self.list_messages_response_last_page
+        ]
         
-        # Mock messages.get API call
-        mock_get = MagicMock()
-        mock_get.execute.return_value = self.sample_message
-        mock_service.users().messages().get.return_value = mock_get
+        emails = self.client.fetch_inbox_emails()
         
-        # Create client without going through authentication
-        client = GmailClient.__new__(GmailClient)
-        client.service = mock_service
-        client.email_storage = self.mock_storage
+        # The first email arrives while only the first page has been listed
+        self.assertEqual(next(emails)['message_id'], 'msg-000')
+        self.assertEqual(mock_list.execute.call_count, 1)
         
+        # The remaining page is listed as iteration continues
+        self.assertEqual(len(list(emails)), GmailClient.BATCH_SIZE)
+        self.assertEqual(mock_list.execute.call_count, 2)
+
+    def test_fetch_inbox_emails_with_look_back(self):
+        """Test fetching emails with look-back period."""
         # Call the method with look_back
         look_back_days = 7
-        emails = client.fetch_inbox_emails(look_back=look_back_days)
+        emails = self.client.fetch_inbox_emails(look_back=look_back_days)
         
         # Verify API call with query parameter
-        call_args = mock_service.users().messages().list.call_args[1]
+        call_args = self.messages_api.list.call_args[1]
         self.assertIn('q', call_args)
         self.assertTrue(call_args['q'].startswith('after:'))
 
-    @patch('src.gmail_client.build')
-    def test_get_email_details(self, mock_build):
+    def test_get_email_details(self):
         """Test retrieving email details."""
-        # Create mock service
-        mock_service = MagicMock()
-        mock_build.return_value = mock_service
-        
-        # Mock messages.get API call
-        mock_get = MagicMock()
-        mock_get.execute.return_value = self.sample_message
-        mock_service.users().messages().get.return_value = mock_get
-        
-        # Create client without going through authentication
-        client = GmailClient.__new__(GmailClient)
-        client.service = mock_service
-        
         # Call the method
         msg_id = 'test-msg-001'
-        email_details = client._get_email_details(msg_id)
+        email_details = self.client._get_email_details(msg_id)
         
         # Verify API call
-        mock_service.users().messages().get.assert_called_with(
+        self.messages_api.get.assert_called_with(
             userId='me', id=msg_id, format='full'
         )
         
@@ -222,69 +291,112 @@ class TestGmailClient(unittest.TestCase):
         self.assertEqual(email_details['date_received'], 'Mon, 22 Mar 2025 10:00:00 +0000')
         self.assertIn('message', email_details)
 
-    @patch('src.gmail_client.build')
-    def test_get_message_content(self, mock_build):
-        """Test extracting message content."""
-        # Create client without going through authentication
-        client = GmailClient.__new__(GmailClient)
+    def test_get_email_details_without_body(self):
+        """Test retrieving only the headers of an email."""
+        # Mock messages.get API call with a metadata-only response
+        metadata_message = {key: value for key, value in self.sample_message.items() if key != 'payload'}
+        metadata_message['payload'] = {'headers': self.sample_message['payload']['headers']}
+        self.messages_api.get.return_value.execute.return_value = metadata_message
         
         # Call the method
-        content = client._get_message_content(self.sample_message)
+        msg_id = 'test-msg-001'
+        email_details = self.client._get_email_details(msg_id, fetch_body=False)
+        
+        # Verify only the needed headers were requested
+        self.messages_api.get.assert_called_with(
+            userId='me', id=msg_id, format='metadata', metadataHeaders=['From', 'Subject', 'Date']
+        )
+        
+        # Verify email details
+        self.assertEqual(email_details['subject'], 'Test Email Subject')
+        self.assertEqual(email_details['message'], '')
+
+    def test_get_message_content(self):
+        """Test extracting message content."""
+        # Call the method
+        content = self.client._get_message_content(self.sample_message)
         
         # Verify content extraction
         self.assertEqual(content, 'This is a test message body.')
 
-    @patch('src.gmail_client.build')
-    def test_modify_email(self, mock_build):
-        """Test modifying email labels."""
-        # Create mock service
-        mock_service = MagicMock()
-        mock_build.return_value = mock_service
+    def test_get_message_content_skips_non_text_parts(self):
+        """Test that only text parts of a multipart message are decoded."""
+        message = {
+            'payload': {
+                'mimeType': 'multipart/mixed',
+                'parts': [
+                    {'mimeType': 'text/plain', 'body': {'data': 'VGhpcyBpcyBhIHRlc3QgbWVzc2FnZSBib2R5Lg=='}},
+                    {'mimeType': 'image/png', 'body': {'data': 'iVBORw0KGgo='}}
+                ]
+            }
+        }
+        
+        content = self.client._get_message_content(message)
         
-        # Mock messages.modify API call
-        mock_modify = MagicMock()
-        mock_service.users().messages().modify.return_value = mock_modify
+        self.assertEqual(content, 'This is a test message body.')
+
+    def test_parse_message_header_case_and_urlsafe_body(self):
+        """Test that header names match regardless of case and bodies use URL-safe base64."""
+        message = {
+            'payload': {
+                'headers': [
+                    {'name': 'FROM', 'value': 'sender@example.com'},
+                    {'name': 'subject', 'value': 'Mixed case headers'},
+                    {'name': 'Date', 'value': 'Mon, 22 Mar 2025 10:00:00 +0000'}
+                ],
+                'body': {'data': 'UHJpY2U6IDU-Mz8gfn5-'}  # Uses the URL-safe '-' character
+            }
+        }
         
-        # Create client without going through authentication
-        client = GmailClient.__new__(GmailClient)
-        client.service = mock_service
+        details = self.client._parse_message('test-msg-001', message)
         
+        self.assertEqual(details['from'], 'sender@example.com')
+        self.assertEqual(details['subject'], 'Mixed case headers')
+        self.assertEqual(details['message'], 'Price: 5>3? ~~~')
+
+    def test_modify_email(self):
+        """Test modifying email labels."""
         # Call the method
         msg_id = 'test-msg-001'
         add_labels = ['IMPORTANT']
         remove_labels = ['UNREAD']
-        client.modify_email(msg_id, add_labels, remove_labels)
+        self.client.modify_email(msg_id, add_labels, remove_labels)
         
         # Verify API call
-        mock_service.users().messages().modify.assert_called_with(
+        self.messages_api.modify.assert_called_with(
             userId='me', 
             id=msg_id, 
             body={'addLabelIds': add_labels, 'removeLabelIds': remove_labels}
         )
 
-    @patch('src.gmail_client.build')
-    def test_api_error_handling(self, mock_build):
+    def test_batch_modify_emails(self):
+        """Test modifying labels of many emails in chunks."""
+        self.client.MODIFY_BATCH_SIZE = 2
+        
+        # Call the method with more IDs than fit in one request
+        msg_ids = ['msg-001', 'msg-002', 'msg-003']
+        self.client.batch_modify_emails(msg_ids, ['IMPORTANT'], ['UNREAD'])
+        
+        # Verify one batchModify call per chunk
+        batch_modify = self.messages_api.batchModify
+        self.assertEqual(batch_modify.call_count, 2)
+        batch_modify.assert_called_with(
+            userId='me',
+            body={'ids': ['msg-003'], 'addLabelIds': ['IMPORTANT'], 'removeLabelIds': ['UNREAD']}
+        )
+
+    def test_api_error_handling(self):
         """Test handling of API errors."""
-        # Create mock service
-        mock_service = MagicMock()
-        mock_build.return_value = mock_service
-        
         # Mock messages.list API call to raise HttpError
-        mock_list = MagicMock()
         mock_resp = MagicMock()
         mock_resp.status = 403
         mock_resp.reason = 'Rate Limit Exceeded'
         http_error = HttpError(mock_resp, b'Rate limit exceeded.')
-        mock_list.execute.side_effect = http_error
-        mock_service.users().messages().list.return_value = mock_list
-        
-        # Create client without going through authentication
-        client = GmailClient.__new__(GmailClient)
-        client.service = mock_service
+        self.messages_api.list.return_value.execute.side_effect = http_error
         
         # Call the method and expect exception
         with self.assertRaises(GmailAPIError):
-            client.fetch_inbox_emails()
+            self.client.fetch_inbox_emails()
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,32 +1,31 @@
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
-import json
-import os
 from datetime import datetime, timedelta
 from src.gmail_client import GmailClient
 from src.email_storage import EmailStorage
 from src.rule_engine import RuleEngine
-from src.main import main
+from src.main import main, _build_parser
+from tests.test_gmail_client import FakeBatchHttpRequest
 
 class TestIntegration(unittest.TestCase):
     """Integration tests for the Gmail Processor application."""
 
-    def setUp(self):
-        """Set up test environment."""
-        # Create temporary paths for testing
-        self.test_db_path = 'test_integration.db'
-        self.test_credentials_path = 'config/credentials.json'
-        self.test_token_path = 'config/token.json'
-        self.test_rules_path = 'config/test_rules.json'
+    @classmethod
+    def setUpClass(cls):
+        """Build the sample data shared by every test once."""
+        # Reference times used to date the sample emails
+        cls.NOW = datetime.now()
+        cls.NOW_TS = int(cls.NOW.timestamp())
+        cls.NOW_HTTP = cls.NOW.strftime('%a, %d %b %Y %H:%M:%S +0000')
         
         # Sample emails for testing
-        self.sample_emails = [
+        cls.sample_emails = [
             {
                 'message_id': 'test-msg-001',
                 'thread_id': 'test-thread-001',
                 'from': 'newsletter@example.com',
                 'subject': 'Weekly Newsletter',
-                'date_received': datetime.now().strftime('%a, %d %b %Y %H:%M:%S +0000'),
+                'date_received': cls.NOW_HTTP,
                 'labels': ['INBOX', 'UNREAD'],
                 'message': 'This is the weekly newsletter with some updates. Click to unsubscribe.'
             },
@@ -35,7 +34,7 @@ class TestIntegration(unittest.TestCase):
                 'thread_id': 'test-thread-002',
                 'from': 'test@tenmiles.com',
                 'subject': 'Interview Preparation',
-                'date_received': datetime.now().strftime('%a, %d %b %Y %H:%M:%S +0000'),
+                'date_received': cls.NOW_HTTP,
                 'labels': ['INBOX'],
                 'message': 'Here are the details for your upcoming interview.'
             },
@@ -44,14 +43,14 @@ class TestIntegration(unittest.TestCase):
                 'thread_id': 'test-thread-003',
                 'from': 'old@example.com',
                 'subject': 'Your Order Confirmation',
-                'date_received': (datetime.now() - timedelta(days=45)).strftime('%a, %d %b %Y %H:%M:%S +0000'),
+                'date_received': (cls.NOW - timedelta(days=45)).strftime('%a, %d %b %Y %H:%M:%S +0000'),
                 'labels': ['INBOX', 'UNREAD'],
                 'message': 'The invoice attached contains your order details.'
             }
         ]
         
         # Sample rules for testing
-        self.sample_rules = [
+        cls.sample_rules = [
             {
                 "description": "Mark newsletters as read",
                 "mode": "any",
@@ -88,15 +87,11 @@ class TestIntegration(unittest.TestCase):
             }
         ]
 
-    def tearDown(self):
-        """Clean up after tests."""
-        # Remove test database if it exists
-        if os.path.exists(self.test_db_path):
-            os.remove(self.test_db_path)
-            
-        # Remove test rules file if it exists
-        if os.path.exists(self.test_rules_path):
-            os.remove(self.test_rules_path)
+    def setUp(self):
+        """Set up test environment."""
+        # Only handed to a mocked open(); no test writes it, so parallel
+        # test workers cannot collide on the filesystem
+        self.test_rules_path = 'config/test_rules.json'
 
     @patch('src.main.EmailStorage')
     @patch('src.main.GmailClient')
@@ -111,29 +106,12 @@ class TestIntegration(unittest.TestCase):
         mock_client_class.return_value = mock_client
         mock_client.fetch_inbox_emails.return_value = self.sample_emails
         
-        mock_engine = MagicMock()
+        # Evaluate with the real sample rules, recording calls for the checks below
+        mock_engine = MagicMock(wraps=RuleEngine.from_rules(self.sample_rules))
         mock_rule_engine_class.return_value = mock_engine
         
-        # Configure get_all_emails to return our sample data
-        mock_storage.get_all_emails.return_value = [
-            # Convert dict to tuple format that storage would return
-            (email['message_id'], email['from'], email['subject'], 
-             int(datetime.now().timestamp()), json.dumps(email['labels']), email['message'])
-            for email in self.sample_emails
-        ]
-        
-        # Configure evaluate to return appropriate actions for each email
-        def evaluate_side_effect(email):
-            msg_id = email[0] if isinstance(email, tuple) else email.get('message_id')
-            if msg_id == 'test-msg-001':
-                return [{"type": "mark_read"}]
-            elif msg_id == 'test-msg-002':
-                return [{"type": "move_message", "mailbox": "IMPORTANT"}]
-            elif msg_id == 'test-msg-003':
-                return [{"type": "mark_read"}, {"type": "move_message", "mailbox": "ARCHIVED"}]
-            return []
-            
-        mock_engine.evaluate.side_effect = evaluate_side_effect
+        # Consume the processed stream the way the real storage would
+        mock_storage.save_stream.side_effect = lambda emails: sum(1 for _ in emails)
         
         # Run the main function
         main(look_back_days=7)
@@ -141,14 +119,24 @@ class TestIntegration(unittest.TestCase):
         # Verify workflow:
         # 1. Client initialized and fetched emails
         mock_client_class.assert_called_once()
-        mock_client.fetch_inbox_emails.assert_called_once_with(look_back=7)
+        mock_client.fetch_inbox_emails.assert_called_once_with(look_back=7, fetch_body=True)
         
         # 2. Rule engine initialized
         mock_rule_engine_class.assert_called_once()
         
-        # 3. Each email was evaluated and had actions applied
+        # 3. Each email was evaluated and had its label changes planned
         self.assertEqual(mock_engine.evaluate.call_count, 3)  # Once for each email
-        self.assertEqual(mock_engine.apply_actions.call_count, 3)  # Once for each email
+        self.assertEqual(mock_engine.plan_actions.call_count, 3)  # Once for each email
+        
+        # 4. Label changes were applied once per distinct (add, remove) combination
+        mock_client.batch_modify_emails.assert_any_call(['test-msg-001'], [], ['UNREAD'])
+        mock_client.batch_modify_emails.assert_any_call(['test-msg-002'], ['IMPORTANT'], [])
+        mock_client.batch_modify_emails.assert_any_call(['test-msg-003'], ['ARCHIVED'], ['UNREAD'])
+        self.assertEqual(mock_client.batch_modify_emails.call_count, 3)
+        
+        # 5. Emails were streamed into storage without reading them back
+        mock_storage.save_stream.assert_called_once()
+        mock_storage.get_all_emails.assert_not_called()
 
     @patch('builtins.open', new_callable=mock_open)
     @patch('json.load')
@@ -168,21 +156,21 @@ class TestIntegration(unittest.TestCase):
         
         # Test newsletter rule
         email = ('test-msg-001', 'test-thread-001', 'newsletter@example.com', 'Newsletter', 
-                 int(datetime.now().timestamp()), '[]', 'Click here to unsubscribe')
+                 self.NOW_TS, '[]', 'Click here to unsubscribe')
         actions = engine.evaluate(email)
         self.assertEqual(len(actions), 1)
         self.assertEqual(actions[0]['type'], 'mark_read')
         
         # Test interview rule
         email = ('test-msg-002', 'test-thread-002', 'hr@tenmiles.com', 'Interview Schedule', 
-                 int(datetime.now().timestamp()), '[]', 'Details for your interview')
+                 self.NOW_TS, '[]', 'Details for your interview')
         actions = engine.evaluate(email)
         self.assertEqual(len(actions), 1)
         self.assertEqual(actions[0]['type'], 'move_message')
         self.assertEqual(actions[0]['mailbox'], 'IMPORTANT')
         
         # Test old invoice rule
-        old_date = datetime.now() - timedelta(days=60)
+        old_date = self.NOW - timedelta(days=60)
         email = ('test-msg-003', 'test-thread-003', 'billing@example.com', 'Your Invoice', 
                  int(old_date.timestamp()), '[]', 'Please find attached invoice')
         actions = engine.evaluate(email)
@@ -191,31 +179,30 @@ class TestIntegration(unittest.TestCase):
         self.assertIn('mark_read', action_types)
         self.assertIn('move_message', action_types)
 
-    @patch('src.gmail_client.build')
-    @patch('src.gmail_client.Credentials')
-    def test_client_storage_integration(self, mock_credentials, mock_build):
+    def test_client_storage_integration(self):
         """Test integration between GmailClient and EmailStorage."""
-        # Create a real EmailStorage with test database
-        storage = EmailStorage(self.test_db_path)
+        # Create a real EmailStorage backed by an in-memory database; EmailStorage
+        # keeps a single connection, so the data lives until it is closed
+        storage = EmailStorage(':memory:')
+        self.addCleanup(storage.close)
         
         # Mock the Gmail API service
         mock_service = MagicMock()
-        mock_build.return_value = mock_service
-        
-        # Make credentials appear valid
-        mock_credentials.from_authorized_user_file.return_value = MagicMock(valid=True)
         
         # Create a mock response for messages.list
         mock_list = MagicMock()
         mock_list.execute.return_value = {
             'messages': [{'id': email['message_id']} for email in self.sample_emails]
         }
-        mock_service.users().messages().list.return_value = mock_list
+        # Calling users().messages() records calls on the mock, so resolve the
+        # messages resource once through return_value instead
+        messages_api = mock_service.users.return_value.messages.return_value
+        messages_api.list.return_value = mock_list
         
-        # Create mock responses for messages.get
+        # Create mock responses for messages.get, looking emails up by ID
+        by_id = {e['message_id']: e for e in self.sample_emails}
         def messages_get_side_effect(**kwargs):
-            msg_id = kwargs['id']
-            email = next((e for e in self.sample_emails if e['message_id'] == msg_id), None)
+            email = by_id.get(kwargs['id'])
             
             if not email:
                 return MagicMock(execute=MagicMock(return_value={}))
@@ -237,19 +224,19 @@ class TestIntegration(unittest.TestCase):
             }
             return mock_response
             
-        mock_service.users().messages().get.side_effect = messages_get_side_effect
-        
-        # Create client with real storage
-        client = GmailClient(self.test_credentials_path, self.test_token_path, storage)
+        messages_api.get.side_effect = messages_get_side_effect
+        mock_service.new_batch_http_request.side_effect = FakeBatchHttpRequest
         
-        # Override service with our mock
+        # Create client without going through authentication
+        client = GmailClient.__new__(GmailClient)
         client.service = mock_service
         
         # Test fetch_inbox_emails
-        emails = client.fetch_inbox_emails()
+        emails = list(client.fetch_inbox_emails())
         
-        # Verify correct number of emails were found and stored
+        # Verify correct number of emails were found, then store them
         self.assertEqual(len(emails), len(self.sample_emails))
+        storage.save_emails(emails)
         
         # Query the database to verify emails were stored
         stored_emails = storage.get_all_emails()
@@ -259,29 +246,21 @@ class TestIntegration(unittest.TestCase):
         for email in stored_emails:
             self.assertIsNotNone(email[5])  # Index 5 is the message field
 
-    @patch('argparse.ArgumentParser.parse_args')
     @patch('src.main.EmailStorage')
     @patch('src.main.GmailClient')
     @patch('src.main.RuleEngine')
-    def test_command_line_arguments(self, mock_rule_engine, mock_client_class, mock_storage, mock_parse_args):
+    def test_command_line_arguments(self, mock_rule_engine, mock_client_class, mock_storage):
         """Test command line argument handling."""
-        # Mock the argument parser
-        mock_args = MagicMock()
-        mock_args.look_back = 14
-        mock_parse_args.return_value = mock_args
-        
         # Set up other mocks
         mock_client = MagicMock()
         mock_client_class.return_value = mock_client
+        mock_rule_engine.return_value.needs_body.return_value = False
         
-        # Import main module
-        from src.main import main
-        
-        # Call directly with the command line args value
-        main(look_back_days=14)
+        # Parse the command line and pass the value through
+        main(look_back_days=_build_parser().parse_args(['--look-back', '14']).look_back)
         
         # Verify look_back parameter was passed correctly
-        mock_client.fetch_inbox_emails.assert_called_once_with(look_back=14)
+        mock_client.fetch_inbox_emails.assert_called_once_with(look_back=14, fetch_body=False)
 
 if __name__ == '__main__':
     unittest.main()